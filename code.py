@@ -2,6 +2,7 @@ import wifi
 import asyncio
 import board
 import time
+import array
 from webserver import Webserver, endpoint
 from digitalio import DigitalInOut, Pull, Direction
 from adafruit_vl53l4cd import VL53L4CD
@@ -35,13 +36,35 @@ label2pin = {'a': pump_a_pin,
 
 i2ABC = ['A', 'B', 'C']
 i2abc = ['a', 'b', 'c']
+label2ABC = {'a': 'A',
+             'b': 'B',
+             'c': 'C'}
+label2start = {'a': "Starting pump A.",
+               'b': "Starting pump B.",
+               'c': "Starting pump C."}
+label2stop = {'a': "Stopping pump A.",
+              'b': "Stopping pump B.",
+              'c': "Stopping pump C."}
+char2label = {'a': 'a', 'b': 'b', 'c': 'c',
+              'A': 'a', 'B': 'b', 'C': 'c'}
 
 target_moisture = [60, 60, 60]
 mlpp = 1
 scmml = 0.00669518060338389 # s/cm/ml
 pipe_volume = 40 # ml
+pump_poll = 0.02 # s
 tof = None
-actual_moisture = [0, 0, 0]
+tof_lock = asyncio.Lock() # one ranging session at a time
+# set by /stop, cancels the current or next watering cycle and blocks manual
+# watering until that cycle has ended
+emergency_stop = False
+actual_moisture = array.array('f', [0.0] * 3)
+actual_moisture_json = b"[0.00, 0.00, 0.00]"
+
+# dry = 20ms per transition, wet = 80ms per transition
+min_ns = 20_000_000
+max_ns = 80_000_000
+moisture_scale = 100 / (max_ns - min_ns)
 
 
 # ---------------------------------------------------------- | General helpers |
@@ -50,89 +73,109 @@ actual_moisture = [0, 0, 0]
 ssid = "Netnet"
 secret = "cirkelsag88"
 def connect():
-    networks = wifi.radio.start_scanning_networks()
+    radio = wifi.radio
+    networks = radio.start_scanning_networks()
     if ssid not in [network.ssid for network in networks]:
         error(f"{ssid} not found, please try again later.")
         return
-    wifi.radio.stop_scanning_networks()
-    wifi.radio.connect(ssid, secret)
-    if not wifi.radio.connected:
+    radio.stop_scanning_networks()
+    radio.connect(ssid, secret)
+    if not radio.connected:
         error(f"Failed to connect to {ssid}")
         return
     info(f"Connected to {ssid}")
 
 
 def start_pump(pump):
-    info(f"Starting pump {pump.upper()}.")
-    label2pin[pump].value = True
+    info(label2start[pump])
+    pin = label2pin[pump]
+    pin.value = True
     
     
 def stop_pump(pump):
-    info(f"Stopping pump {pump.upper()}.")
-    label2pin[pump].value = False
+    info(label2stop[pump])
+    pin = label2pin[pump]
+    pin.value = False
 
 
-async def dispense_water(pump, ml, tof):
+async def dispense_water(pump, ml, cm):
+    if emergency_stop:
+        warning(f"Emergency stop active, not starting pump {label2ABC[pump]}.")
+        return
     try:
-        cm = sample_tof(tof)
         water_time = scmml * cm * (ml + pipe_volume)
         info(f"Dispensing {ml} ml")
         start_pump(pump)
-        await asyncio.sleep(water_time)
+        # poll against a deadline so the pump can be stopped early
+        deadline = time.monotonic_ns() + int(water_time * 1_000_000_000)
+        while time.monotonic_ns() < deadline:
+            await asyncio.sleep(pump_poll)
+            if emergency_stop:
+                warning(f"Emergency stop of pump {label2ABC[pump]}.")
+                break
         stop_pump(pump)
     except:
         stop_pump(pump)
         raise    
 
-async def moisture_readings():                                                        
-  results = []
+async def moisture_readings(results):
+  monotonic_ns = time.monotonic_ns
+  low, high, scale = min_ns, max_ns, moisture_scale
 
   for i in range(0, 3):
     # count time for sensor to "tick" 25 times
     sensor = moisture_sensor_pins[i]
 
     last_value = sensor.value
-    start = time.monotonic_ns()
+    start = now = monotonic_ns()
     first = None
     last = None
     ticks = 0
-    while ticks < 10 and time.monotonic_ns() - start <= 1_000_000_000:
+    polls = 0
+    while ticks < 10 and now - start <= 1_000_000_000:
       value = sensor.value
+      polls += 1
       if last_value != value:
+        # only read the clock on transitions, reuse it for the timeout check
+        now = monotonic_ns()
         if first == None:
-          first = time.monotonic_ns()
-        last = time.monotonic_ns()
+          first = now
+        last = now
         ticks += 1
         last_value = value
-      await asyncio.sleep(0)
+      elif polls & 63 == 0:
+        now = monotonic_ns()
+      if polls & 31 == 0:
+        # yield in batches, the signal is slow compared to a scheduler pass
+        await asyncio.sleep(0)
 
     if not first or not last:
-      results.append(0.0)
+      results[i] = 0.0
       continue
 
     # calculate the average tick between transitions in ms
     average = (last - first) / ticks
     # scale the result to a 0...100 range where 0 is very dry
     # and 100 is standing in water
-    #
-    # dry = 10ms per transition, wet = 80ms per transition
-    min_ns = 20_000_000
-    max_ns = 80_000_000
-    average = max(min_ns, min(max_ns, average)) # clamp range
-    scaled = ((average - min_ns) / (max_ns - min_ns)) * 100
-    results.append(round(scaled, 2))
-  
-  return results
-
-
-def sample_tof(tof, count=1):
-    tof.start_ranging()
-    distance = 0
-    for c in range(count):
-        while not tof.data_ready: pass
-        tof.clear_interrupt()
-        distance += tof.distance
-    tof.stop_ranging()
+    average = (low if average < low
+               else high if average > high
+               else average) # clamp range
+    results[i] = (average - low) * scale
+
+
+async def sample_tof(tof, count=1):
+    # other callers must not stop ranging while this one yields
+    async with tof_lock:
+        tof.start_ranging()
+        try:
+            distance = 0
+            for c in range(count):
+                while not tof.data_ready:
+                    await asyncio.sleep(0) # let other tasks run while ranging
+                tof.clear_interrupt()
+                distance += tof.distance
+        finally:
+            tof.stop_ranging()
     return distance / count
 
         
@@ -140,18 +183,28 @@ def sample_tof(tof, count=1):
 
 
 async def watering_loop():
-    global actual_moisture
+    global actual_moisture_json, emergency_stop
     while True:
         info("Reading sensors...")
-        actual_moisture = await moisture_readings()
-        info("Sensor report:", actual_moisture)
+        await moisture_readings(actual_moisture)
+        readings = ", ".join("%.2f" % x for x in actual_moisture)
+        actual_moisture_json = ("[" + readings + "]").encode()
+        info("Sensor report:", readings)
+        cm = None
         for i, (reading, target) in enumerate(zip(actual_moisture,
                                                   target_moisture)):
+            if emergency_stop:
+                warning("Emergency stop, skipping rest of watering cycle.")
+                break
             if reading < target:
                 info(f"Moisture too low in plant {i2ABC[i]}")
+                if cm is None:
+                    # tank level does not change noticeably within a cycle
+                    cm = await sample_tof(tof, count=3)
                 diff = target - reading
                 ml = diff * mlpp
-                await dispense_water(i2abc[i], ml, tof)
+                await dispense_water(i2abc[i], ml, cm)
+        emergency_stop = False # a stop only lasts for one cycle
         await asyncio.sleep(15 * 60) # 15 minutes between waterings
 
 
@@ -164,12 +217,13 @@ async def main():
     tof.inter_measurement = 0
     tof.timing_budget = 200 # Maximum timing budget
     info("Initialization done.")
-    if not wifi.radio.connected:
+    radio = wifi.radio
+    if not radio.connected:
         connect()
-    latency = wifi.radio.ping(wifi.radio.ipv4_gateway)
+    latency = radio.ping(radio.ipv4_gateway)
     if latency is None:
         warning("Could not ping gateway!")
-    info(f"IP: {wifi.radio.ipv4_address}")
+    info(f"IP: {radio.ipv4_address}")
     await asyncio.gather(Webserver(1337), watering_loop())
 
 
@@ -177,13 +231,22 @@ async def main():
 async def water(pump=None, volume=None):
     if pump is None or volume is None:
         return (404, "Not found")
-    pump = pump[-1].lower()
-    await dispense_water(pump, float(volume), tof)
+    pump = char2label.get(pump[-1])
+    if pump is None:
+        return (404, "Not found")
+    if emergency_stop:
+        return (503, "Emergency stop active")
+    cm = await sample_tof(tof)
+    await dispense_water(pump, float(volume), cm)
+
+@endpoint("/stop")
+async def stop():
+    global emergency_stop
+    emergency_stop = True
 
 @endpoint("/moisture", method="GET")
 async def moisture():
-    global actual_moisture
-    return str(actual_moisture)
+    return actual_moisture_json
 
 asyncio.run(main())
 
@@ -3,18 +3,34 @@ import asyncio
 import os
 import wifi
 import collections
+import errno
 from log import info
 
 client_queue = collections.deque((), 5)
-http_version = "HTTP/1.1"
+client_ready = asyncio.Event()
+HTTP_VERSION_PREFIX = b"HTTP/1.1 "
 WORKERS = 5
 WORKER_BUFFER_SIZE = 1024
+HEADER_BUFFER_SIZE = 64
+ROUTE_HOPS = 4
+HEADER_POOL = [bytearray(HEADER_BUFFER_SIZE) for _ in range(WORKERS)]
+# One contiguous slab for all worker receive buffers to avoid fragmenting the
+# heap. Each worker gets a memoryview slice of it.
+_SLAB = bytearray(WORKERS * WORKER_BUFFER_SIZE)
+
+# Static files never change at runtime, read them once at boot.
+HTML_CACHE = {}
+for _name in os.listdir("/html"):
+    with open("/html/" + _name, "rb") as _f:
+        HTML_CACHE[_name.encode()] = _f.read()
+ERROR_HTML = HTML_CACHE[b"error.html"]
 
 
 class Router:
     table = {
-        "": "index.html",
-        "water": "index.html"
+        b"": b"index.html",
+        b"water": b"index.html",
+        b"stop": b"index.html"
     }
 
 
@@ -23,15 +39,39 @@ class Client:
         self.socket = socket
         self.address = address
         
-    def send(self, *args):
-        """Try to send data to client.
+    async def send(self, data) -> bool:
+        """Try to send all data to client.
     
-        If sending data fails, close the socket.
+        `socket.send` may only write part of the data, so keep sending the
+        remainder until everything is written. If the socket is not ready to
+        send, yield to the scheduler and retry. If sending data fails, close
+        the socket.
+
+        Parameters
+        ----------
+        data: bytes, bytearray or memoryview
+            Data to send.
+
+        Returns
+        -------
+        sent: bool
+            True if all data was sent.
         """
-        try:
-            self.socket.send(*args)
-        except:
-            self.close()
+        view = memoryview(data)
+        size = len(view)
+        sent = 0
+        while sent < size:
+            try:
+                sent += self.socket.send(view[sent:])
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    self.close()
+                    return False
+                await asyncio.sleep(0)
+            except:
+                self.close()
+                return False
+        return True
     
     def close(self):
         if self.socket:
@@ -61,7 +101,8 @@ class Client:
         Returns
         -------
         data_read: int
-            The amount of data read into the buffer.
+            The amount of data read into the buffer, 0 if the client closed
+            the connection.
         """
         while True:
             try:
@@ -96,71 +137,148 @@ async def accept_connection(socket) -> Client:
             await asyncio.sleep(0)
 
 
-def extract_request(request: bytearray) -> tuple[Optional[str],
-                                                 Optional[str],
-                                                 Optional[dict],
-                                                 Optional[dict]]:
+def extract_args(data: bytes, start: int, stop: int, kwargs: dict) -> None:
+    """Extract arguments from data slice and put in kwargs dict.
+    
+    Parameters
+    ----------
+    data: bytes
+        Raw request data.
+    start: int
+        Index of the first byte of the argument string.
+    stop: int
+        Index after the last byte of the argument string.
+    kwargs: dict
+        Dict to put the arguments in.
+    """
+    while start < stop:
+        amp = data.find(b"&", start, stop)
+        if amp < 0:
+            amp = stop
+        if amp > start:
+            eq = data.find(b"=", start, amp)
+            if eq < 0:
+                kwargs[data[start:amp].decode()] = ""
+            else:
+                kwargs[data[start:eq].decode()] = data[eq + 1:amp].decode()
+        start = amp + 1
+
+
+def extract_request(header: bytes, body: bytes) -> tuple[Optional[bytes],
+                                                         Optional[bytes],
+                                                         Optional[dict]]:
     """Extract data from HTTP request.
 
-    Extracts headers, arguments, path and method in request.
+    Extracts arguments, path and method in request. The request is scanned
+    with `find` on the raw bytes. Path and method are kept as bytes for
+    dispatch, only arguments are decoded. Headers are skipped since no
+    endpoint uses them.
     
     Parameters
     ----------
-    request: bytearray
-        Bytearray of raw request data.
+    header: bytes
+        Raw request line and headers.
+    body: bytes
+        Raw request body.
         
     Returns
     -------
-    path: str, optional
+    path: bytes, optional
         The path requested.
-    method: str, optional
+    method: bytes, optional
         The HTTP method used in the request.
-    headers: dict, optional
-        All headers in the request.
     kwargs: dict, optional
         Any arguments supplied in the request.
     """
     try:
-        headers = {}
         kwargs = {}
-        _str = request.decode()
-        header, _, body = _str.partition("\r\n\r\n")
-        lines = header.splitlines()
-        method, path, _ = lines[0].split()
-        path, _, args = path.partition("?")
-        
-        def extract_args(args: str) -> None:
-            """Extract arguments from string and put in kwargs dict.
-            
-            Parameters
-            ----------
-            args: str
-                Argument string.
-            """
-            args = args.split("&")
-            for arg in args:
-                if not arg:
-                    continue
-                key, _, value = arg.partition("=")
-                kwargs[key] = value
-                
-        for line in lines[1:]:
-            if not line:
-                continue
-            key, _, value = line.partition(":")
-            value = value.strip()
-            headers[key] = value
-        if body:
-            lines = body.splitlines()
-            for line in lines:
-                extract_args(line)
-        return path, method, headers, kwargs
+        line_end = header.find(b"\r\n")
+        if line_end < 0:
+            line_end = len(header)
+        space1 = header.find(b" ", 0, line_end)
+        space2 = header.find(b" ", space1 + 1, line_end)
+        if space1 < 0 or space2 < 0:
+            return None, None, None
+        method = header[:space1]
+        query = header.find(b"?", space1 + 1, space2)
+        path = header[space1 + 1:space2 if query < 0 else query]
+        start = 0
+        # Only walk the body lines if there is any argument in it.
+        if body.find(b"=") >= 0:
+            while start < len(body):
+                stop = body.find(b"\n", start)
+                if stop < 0:
+                    stop = len(body)
+                if stop > start and body[stop - 1] == 13:
+                    extract_args(body, start, stop - 1, kwargs)
+                else:
+                    extract_args(body, start, stop, kwargs)
+                start = stop + 1
+        return path, method, kwargs
     except:
-        return None, None, None, None
+        return None, None, None
+
 
+def content_length(header: bytes) -> int:
+    """Get the value of the Content-Length header.
 
-async def handle_connection(client: Client, buffer: bytearray,
-                            buffer_size: int) -> None:
+    Header names are case-insensitive, so the header is lowercased once and
+    the name is only matched at the start of a header line.
+
+    Parameters
+    ----------
+    header: bytes
+        Raw request line and headers.
+
+    Returns
+    -------
+    length: int
+        Size of the request body, 0 if the header is missing or invalid.
+    """
+    header = header.lower()
+    start = header.find(b"\r\ncontent-length:")
+    if start < 0:
+        return 0
+    start += len(b"\r\ncontent-length:")
+    stop = header.find(b"\r\n", start)
+    try:
+        return int(header[start:stop].decode().strip())
+    except ValueError:
+        return 0
+
+
+def write_header(buffer: bytearray, rc: str) -> Union[memoryview, bytes]:
+    """Write HTTP status line and end of headers into buffer.
+
+    If the header does not fit in the buffer, it is built as new bytes instead
+    so the preallocated buffer never grows.
+
+    Parameters
+    ----------
+    buffer: bytearray
+        Buffer to write the header into.
+    rc: str
+        Return code and message, ie. "200 OK".
+
+    Returns
+    -------
+    header: memoryview or bytes
+        The header to send.
+    """
+    parts = (HTTP_VERSION_PREFIX, rc.encode(), b"\r\n\r\n")
+    size = len(parts[0]) + len(parts[1]) + len(parts[2])
+    if size > len(buffer):
+        return b"".join(parts)
+    n = 0
+    for part in parts:
+        buffer[n:n + len(part)] = part
+        n += len(part)
+    return memoryview(buffer)[:n]
+
+
+async def handle_connection(client: Client, buffer: memoryview,
+                            buffer_size: int,
+                            header_buffer: bytearray) -> None:
     """Handle incoming connection.
     
     Handles HTTP requests and calls API endpoint if needed.
@@ -169,53 +287,94 @@ async def handle_connection(client: Client, buffer: bytearray,
     ----------
     client: Client
         Client object that is representing the connection.
-    buffer: bytearray
-        Buffer to store read and write data in.
+    buffer: memoryview
+        Buffer to store read data in.
     buffer_size: int
         Size of the buffer.
+    header_buffer: bytearray
+        Preallocated buffer to compose the response header in.
     """
-    global http_version
-    read_bytes = await client.recv_data(buffer, buffer_size)
-    extracted = extract_request(buffer[:read_bytes])
+    recv_data = client.recv_data
+    send = client.send
+    close = client.close
+    read_bytes = 0
+    expected = buffer_size
+    header_end = -1
+    header = b""
+    # Requests may arrive in several segments, read until end of headers and
+    # then until the body announced by Content-Length has arrived.
+    while read_bytes < expected:
+        n = await recv_data(buffer[read_bytes:], buffer_size - read_bytes)
+        if n == 0:
+            break
+        start = read_bytes - 3 if read_bytes > 3 else 0
+        read_bytes += n
+        if header_end < 0:
+            # memoryview has no find, so each new segment is copied to scan it.
+            header_end = bytes(buffer[start:read_bytes]).find(b"\r\n\r\n")
+            if header_end >= 0:
+                header_end += start + 4
+                header = bytes(buffer[:header_end])
+                expected = min(header_end + content_length(header),
+                               buffer_size)
+    if header_end < 0:
+        # No end of headers, parse what was received as headers only.
+        header = bytes(buffer[:read_bytes])
+        header_end = read_bytes
+    extracted = extract_request(header, bytes(buffer[header_end:read_bytes]))
     response = await WebAPI.handle_api(*extracted)
-    path, method, headers, kwargs = extracted
+    path, method, kwargs = extracted
     
     if path is None:
-        client.close()
+        close()
         return
     
     if response is None:
         html, rc = path2html(path)
     elif isinstance(response, tuple):
-        rc = str(response[0]) + response[1]
+        rc = str(response[0]) + " " + response[1]
         if len(response) == 3:
             html = response[2]
+        elif response[0] == 200:
+            html, _ = path2html(path)
         else:
-            html, _ = path2html(path if response[0] == 200 else "/error.html")
+            html = ERROR_HTML
     else:
         html, rc = response, "200 OK"
-    response = f"{http_version} {rc}\r\n\r\n{html}"
-    client.send(response)
-    client.close()
+    if isinstance(html, str):
+        html = html.encode()
+    # Send the body straight from its buffer to avoid copying it.
+    if await send(write_header(header_buffer, rc)):
+        await send(html)
+    close()
 
 
-async def worker(_id: int, buffer_size: int) -> None:
+async def worker(_id: int, buffer: memoryview) -> None:
     """Worker handles clients in the client queue.
 
+    Idle workers block on `client_ready` instead of polling the queue.
+
     Parameters
     ----------
     _id: int
         Id of the worker.
-    buffer_size: int
-        Size of the buffer to allocate.
+    buffer: memoryview
+        The worker's slice of the receive slab.
     """
-    buffer = bytearray(buffer_size)
+    buffer_size = len(buffer)
+    header_buffer = HEADER_POOL[_id]
+    popleft = client_queue.popleft
+    clear = client_ready.clear
+    wait = client_ready.wait
     while True:
         try:
-            client = client_queue.popleft()
-            await handle_connection(client, buffer, buffer_size)
+            client = popleft()
         except IndexError:
-            await asyncio.sleep(0)
+            # Queue is empty, sleep until the server loop hands over a client.
+            clear()
+            await wait()
+            continue
+        await handle_connection(client, buffer, buffer_size, header_buffer)
 
 
 async def Webserver(port: int) -> None:
@@ -226,10 +385,11 @@ async def Webserver(port: int) -> None:
     port: int
         Port to host HTTP server on.
     """
-    server_workers = []
-    for i in range(WORKERS):
-        server_workers.append(worker(i, WORKER_BUFFER_SIZE))
-    await asyncio.gather(server_loop(port), *server_workers)
+    slab = memoryview(_SLAB)
+    size = WORKER_BUFFER_SIZE
+    await asyncio.gather(server_loop(port),
+                         *(worker(i, slab[i * size:(i + 1) * size])
+                           for i in range(WORKERS)))
 
 
 async def server_loop(port: int) -> None:
@@ -248,42 +408,42 @@ async def server_loop(port: int) -> None:
     s.bind(("", port))
     s.listen(5)
     s.setblocking(False)
-    http_version = "HTTP/1.1"
+    append = client_queue.append
+    notify = client_ready.set
     while True:
         client = await accept_connection(s)
-        client_queue.append(client)
+        append(client)
+        notify()
 
 
-def path2html(path: str) -> str:
+def path2html(path: bytes) -> tuple[bytes, str]:
     """Get html from path.
 
-    If `path` is not found as a file, recursive call with new path from routing
-    table.
-    WARNING: Can get stuck if two routes point to eachother.
+    If `path` is not found as a file, follow the routing table to a new path.
+    At most `ROUTE_HOPS` paths are tried, so routes pointing to eachother
+    result in an error instead of hanging the worker.
     
     Parameters
     ----------
-    path: str
+    path: bytes
         HTTP path to find html file for.
     
     Returns
     -------
-    html: str
+    html: bytes
         The HTML representing the path.
+    rc: str
+        Return code and message.
     """
-    path = path.strip("/")
-    files = os.listdir("/html")
-    if path not in files:
-        npath = Router.table.get(path)
-        if npath:
-            return path2html(npath)
-        with open("/html/error.html") as f:
-            return f.read(), "404 Not Found"
-    for file in files:
-        if not file == path:
-            continue
-        with open("/html/" + file) as f:
-            return f.read(), "200 OK"
+    path = path.strip(b"/")
+    for _ in range(ROUTE_HOPS):
+        html = HTML_CACHE.get(path)
+        if html is not None:
+            return html, "200 OK"
+        path = Router.table.get(path)
+        if not path:
+            return ERROR_HTML, "404 Not Found"
+    return ERROR_HTML, "508 Loop Detected"
 
 
 def endpoint(path: str, method: str="POST"):
@@ -297,26 +457,24 @@ def endpoint(path: str, method: str="POST"):
         Method required to access the endpoint.
     """
     def decorator(func):
-        WebAPI.endpoints[path] = Endpoint(path, method, func)
+        key = (method.encode(), path.encode())
+        WebAPI.endpoints[key] = Endpoint(path, func)
         return func
     return decorator
 
 
 class Endpoint:
-    def __init__(self, path: str, method: str, func: Callable):
+    def __init__(self, path: str, func: Callable):
         """Initialize an endpoint object.
 
         Parameters
         ----------
         path: str
             Path to the API endpoint.
-        method: str
-            Method required to access the endpoint.
         func: Callable
             Function/Coroutine to be called when accessing API.
         """
         self.path = path
-        self.method = method
         self.func = func
     
     def __hash__(self) -> int:
@@ -324,32 +482,32 @@ class Endpoint:
 
 
 class WebAPI:
-    """A collection of all endpoints registered on the class."""
+    """A collection of all endpoints registered on the class.
+
+    Endpoints are keyed on (method, path) as bytes, so dispatch is a single
+    lookup on the values returned by `extract_request`.
+    """
     endpoints = {}
     
     @classmethod
-    async def handle_api(cls, path: str, method: str, headers: dict,
+    async def handle_api(cls, path: bytes, method: bytes,
                          kwargs: dict) -> Untion[tuple[int, str, str],
                                                 str, tuple[int, str]]:
         """Handle API request and return response.
         
         Parameters
         ----------
-        path: str
+        path: bytes
             API endpoint.
-        method: str
-            HTTP method allowed.
-        headers: dict
-            HTTP request headers.
+        method: bytes
+            HTTP method used.
         kwargs: dict
             HTTP request arguments.
         """
-        endpoint = cls.endpoints.get(path)
+        endpoint = cls.endpoints.get((method, path))
         if endpoint is None:
             return
-        if endpoint.method == method:
-            rt = await endpoint.func(**kwargs)
-            if rt is not None:
-                return rt # (Return code, return message)
-                          # html
-                          # (Return coce, return message, html)
\ No newline at end of file
+        # (Return code, return message)
+        # html
+        # (Return code, return message, html)
+        return await endpoint.func(**kwargs)
\ No newline at end of file